@@ -2,18 +2,24 @@
 
 import os
 import json
+import hmac
+import logging
 import secrets
+import time
 import urllib.parse
+from typing import AsyncIterator
 from fastapi import Request, HTTPException
 from fastapi.responses import HTMLResponse
 import httpx
 import asyncio
-import base64
-import requests
+import orjson
+from cachetools import TTLCache
 from dotenv import load_dotenv
 
 from integrations.integration_item import IntegrationItem
-from redis_client import add_key_value_redis, get_value_redis, delete_key_redis
+from redis_client import add_key_value_redis, get_value_redis, delete_key_redis, add_key_value_delete_key_redis
+
+logger = logging.getLogger(__name__)
 
 # Load environment variables
 load_dotenv()
@@ -33,6 +39,104 @@ scopes = (
     'crm.objects.meetings.read crm.objects.notes.read crm.objects.emails.read'
 )
 
+# Everything but the state is fixed, so encode it once at import
+_auth_query = urllib.parse.urlencode({
+    'client_id': CLIENT_ID,
+    'redirect_uri': REDIRECT_URI,
+    'scope': scopes,
+})
+_auth_url_prefix = f"{authorization_url}?{_auth_query}&state="
+
+# HubSpot object types to fetch, mapped to the singular item type used in item ids
+HUBSPOT_ITEM_TYPES = {
+    'contacts': 'contact',
+    'companies': 'company',
+    'deals': 'deal',
+    'tickets': 'ticket',
+    'tasks': 'task',
+    'calls': 'call',
+    'meetings': 'meeting',
+    'notes': 'note',
+    'emails': 'email',
+}
+
+# Only the properties create_integration_item_metadata_object reads
+HUBSPOT_PROPERTIES = [
+    'firstname', 'lastname', 'email', 'name', 'domain', 'dealname', 'subject', 'createdate', 'lastmodifieddate'
+]
+
+# Number of search pages requested past the current cursor without waiting for
+# the previous response; they still start at the search rate below, so this
+# overlaps round trips rather than bursting
+SEARCH_PAGE_LOOKAHEAD = 4
+# HubSpot's search API refuses to page beyond this many results per query
+SEARCH_RESULT_CAP = 10000
+# Most ids HubSpot accepts in one batch associations read
+ASSOCIATION_BATCH_SIZE = 1000
+# HubSpot allows 100 requests per 10 seconds per token on the standard tier
+HUBSPOT_REQUESTS_PER_SECOND = 10
+# HubSpot allows 5 search requests per second per token; keep a little headroom
+HUBSPOT_SEARCH_REQUESTS_PER_SECOND = 4
+# Attempts per request before a 429 or 5xx response is handed back to the caller
+HUBSPOT_MAX_RETRIES = 5
+
+# One keep-alive client for the whole process so OAuth callbacks and item
+# fetches reuse connections and multiplex over HTTP/2
+_http_client = httpx.AsyncClient(
+    http2=True,
+    timeout=httpx.Timeout(30.0),
+    limits=httpx.Limits(max_connections=100, max_keepalive_connections=50),
+)
+
+# Recently read credentials, keyed by (org_id, user_id), to skip Redis on repeat syncs
+_credentials_cache = TTLCache(maxsize=1024, ttl=60)
+
+# Earliest time the next request, and the next search request, may start, keyed by access token
+_request_schedule = TTLCache(maxsize=1024, ttl=60)
+_search_schedule = TTLCache(maxsize=1024, ttl=60)
+
+def _invalidate_hubspot_credentials(access_token: str):
+    stale = [key for key, credentials in _credentials_cache.items() if credentials.get('access_token') == access_token]
+    for key in stale:
+        _credentials_cache.pop(key, None)
+
+async def _wait_for_rate_slot(schedule: TTLCache, key: str, rate: float):
+    # Reserve the next free slot before sleeping so concurrent callers queue up
+    # one interval apart instead of all waking at the same moment
+    now = time.monotonic()
+    slot = max(now, schedule.get(key, now))
+    schedule[key] = slot + 1 / rate
+    if slot > now:
+        await asyncio.sleep(slot - now)
+
+def _retry_after(response: httpx.Response) -> float:
+    try:
+        return float(response.headers.get('Retry-After', 1))
+    except ValueError:
+        return 1.0
+
+async def _hubspot_request(
+    client: httpx.AsyncClient, method: str, url: str, access_token: str, search=False, **kwargs
+) -> httpx.Response:
+    """Send a HubSpot API request under the per-token rate limits, retrying throttled calls"""
+    for attempt in range(HUBSPOT_MAX_RETRIES):
+        if search:
+            await _wait_for_rate_slot(_search_schedule, access_token, HUBSPOT_SEARCH_REQUESTS_PER_SECOND)
+        await _wait_for_rate_slot(_request_schedule, access_token, HUBSPOT_REQUESTS_PER_SECOND)
+
+        response = await client.request(method, url, **kwargs)
+
+        if response.status_code != 429 and response.status_code < 500:
+            return response
+
+        if attempt + 1 < HUBSPOT_MAX_RETRIES:
+            await asyncio.sleep(_retry_after(response))
+
+    return response
+
+async def close_hubspot_client():
+    await _http_client.aclose()
+
 async def authorize_hubspot(user_id, org_id):
     state_data = {
         'state': secrets.token_urlsafe(32),
@@ -42,16 +146,7 @@ async def authorize_hubspot(user_id, org_id):
     encoded_state = json.dumps(state_data)
     await add_key_value_redis(f'hubspot_state:{org_id}:{user_id}', encoded_state, expire=600)
 
-    # Properly URL encode parameters
-    params = {
-        'client_id': CLIENT_ID,
-        'redirect_uri': REDIRECT_URI,
-        'scope': scopes,
-        'state': encoded_state
-    }
-    
-    auth_url = f"{authorization_url}?{urllib.parse.urlencode(params)}"
-    return auth_url
+    return _auth_url_prefix + urllib.parse.quote_plus(encoded_state)
 
 async def oauth2callback_hubspot(request: Request):
     if request.query_params.get('error'):
@@ -61,37 +156,48 @@ async def oauth2callback_hubspot(request: Request):
     encoded_state = request.query_params.get('state')
     state_data = json.loads(encoded_state)
 
-    original_state = state_data.get('state')
     user_id = state_data.get('user_id')
     org_id = state_data.get('org_id')
 
     saved_state = await get_value_redis(f'hubspot_state:{org_id}:{user_id}')
 
-    if not saved_state or original_state != json.loads(saved_state).get('state'):
+    # Redis holds the exact blob we handed out, so compare it whole instead of decoding it
+    if not saved_state or not hmac.compare_digest(encoded_state.encode(), saved_state):
         raise HTTPException(status_code=400, detail='State does not match.')
 
-    async with httpx.AsyncClient() as client:
-        response, _ = await asyncio.gather(
-            client.post(
-                token_url,
-                data={
-                    'grant_type': 'authorization_code',
-                    'client_id': CLIENT_ID,
-                    'client_secret': CLIENT_SECRET,
-                    'redirect_uri': REDIRECT_URI,
-                    'code': code
-                },
-                headers={
-                    'Content-Type': 'application/x-www-form-urlencoded'
-                }
-            ),
-            delete_key_redis(f'hubspot_state:{org_id}:{user_id}'),
+    try:
+        response = await _http_client.post(
+            token_url,
+            data={
+                'grant_type': 'authorization_code',
+                'client_id': CLIENT_ID,
+                'client_secret': CLIENT_SECRET,
+                'redirect_uri': REDIRECT_URI,
+                'code': code
+            },
+            headers={
+                'Content-Type': 'application/x-www-form-urlencoded'
+            }
         )
 
-    if response.status_code != 200:
-        raise HTTPException(status_code=400, detail='Failed to exchange code for token')
+        if response.status_code != 200:
+            raise HTTPException(status_code=400, detail='Failed to exchange code for token')
+    except Exception:
+        # The state is single use, so spend it even when the exchange fails
+        await delete_key_redis(f'hubspot_state:{org_id}:{user_id}')
+        raise
 
-    await add_key_value_redis(f'hubspot_credentials:{org_id}:{user_id}', json.dumps(response.json()), expire=600)
+    credentials = response.json()
+
+    # Store the credentials and drop the spent state in a single round trip.
+    # Credentials live as long as the access token they carry.
+    await add_key_value_delete_key_redis(
+        f'hubspot_credentials:{org_id}:{user_id}',
+        json.dumps(credentials),
+        f'hubspot_state:{org_id}:{user_id}',
+        expire=int(credentials.get('expires_in', 1800)),
+    )
+    _credentials_cache.pop((org_id, user_id), None)
     
     close_window_script = """
     <html>
@@ -103,56 +209,62 @@ async def oauth2callback_hubspot(request: Request):
     return HTMLResponse(content=close_window_script)
 
 async def get_hubspot_credentials(user_id, org_id):
+    credentials = _credentials_cache.get((org_id, user_id))
+    if credentials is not None:
+        return credentials
+
     credentials = await get_value_redis(f'hubspot_credentials:{org_id}:{user_id}')
     if not credentials:
         raise HTTPException(status_code=400, detail='No credentials found.')
     credentials = json.loads(credentials)
     if not credentials:
         raise HTTPException(status_code=400, detail='No credentials found.')
-    await delete_key_redis(f'hubspot_credentials:{org_id}:{user_id}')
+    _credentials_cache[(org_id, user_id)] = credentials
 
     return credentials
 
+_EMPTY = {}
+
+def _contact_name(properties: dict, obj_id, item_type: str) -> str:
+    # For contacts, use firstname + lastname or email as fallback
+    firstname = properties.get('firstname')
+    lastname = properties.get('lastname')
+    if firstname and lastname:
+        return f"{firstname} {lastname}".strip()
+    return firstname or lastname or properties.get('email') or f"Contact {obj_id}"
+
+def _company_name(properties: dict, obj_id, item_type: str) -> str:
+    return properties.get('name') or properties.get('domain') or f"Company {obj_id}"
+
+def _deal_name(properties: dict, obj_id, item_type: str) -> str:
+    return properties.get('dealname') or f"Deal {obj_id}"
+
+def _generic_name(properties: dict, obj_id, item_type: str) -> str:
+    # Generic fallback for other object types
+    return properties.get('name') or properties.get('subject') or f"{item_type.title()} {obj_id}"
+
+_NAME_EXTRACTORS = {
+    'contact': _contact_name,
+    'company': _company_name,
+    'deal': _deal_name,
+}
+
 def create_integration_item_metadata_object(
-    response_json: dict, item_type: str, parent_id=None, parent_name=None
+    response_json: dict, item_type: str, parent_id=None, parent_name=None, id_suffix=None
 ) -> IntegrationItem:
     """Creates an integration metadata object from the HubSpot API response"""
-    
+    properties = response_json.get('properties') or _EMPTY
+    obj_id = response_json['id']
+
     # Extract name based on object type
-    name = None
-    if item_type == 'contact':
-        # For contacts, use firstname + lastname or email as fallback
-        properties = response_json.get('properties', {})
-        firstname = properties.get('firstname', '')
-        lastname = properties.get('lastname', '')
-        email = properties.get('email', '')
-        
-        if firstname or lastname:
-            name = f"{firstname} {lastname}".strip()
-        elif email:
-            name = email
-        else:
-            name = f"Contact {response_json.get('id', 'Unknown')}"
-            
-    elif item_type == 'company':
-        properties = response_json.get('properties', {})
-        name = properties.get('name') or properties.get('domain') or f"Company {response_json.get('id', 'Unknown')}"
-        
-    elif item_type == 'deal':
-        properties = response_json.get('properties', {})
-        name = properties.get('dealname') or f"Deal {response_json.get('id', 'Unknown')}"
-        
-    else:
-        # Generic fallback for other object types
-        properties = response_json.get('properties', {})
-        name = properties.get('name') or properties.get('subject') or f"{item_type.title()} {response_json.get('id', 'Unknown')}"
+    name = _NAME_EXTRACTORS.get(item_type, _generic_name)(properties, obj_id, item_type)
 
     # Extract timestamps
-    created_time = response_json.get('createdAt') or response_json.get('properties', {}).get('createdate')
-    modified_time = response_json.get('updatedAt') or response_json.get('properties', {}).get('lastmodifieddate')
+    created_time = response_json.get('createdAt') or properties.get('createdate')
+    modified_time = response_json.get('updatedAt') or properties.get('lastmodifieddate')
 
     integration_item_metadata = IntegrationItem(
-        id=f"{response_json.get('id')}_{item_type}",
+        id=obj_id + (id_suffix or '_' + item_type),
         type=item_type,
         name=name,
         creation_time=created_time,
@@ -163,40 +275,155 @@ def create_integration_item_metadata_object(
 
     return integration_item_metadata
 
-def fetch_hubspot_objects(access_token: str, object_type: str, limit=100) -> list:
-    """Fetch objects from HubSpot CRM API"""
-    url = f'https://api.hubapi.com/crm/v3/objects/{object_type}'
+async def fetch_hubspot_page(
+    client: httpx.AsyncClient, access_token: str, object_type: str, after=0, last_id=None, limit=100
+) -> dict:
+    """Fetch a single page of objects from the HubSpot CRM search API"""
+    url = f'https://api.hubapi.com/crm/v3/objects/{object_type}/search'
     headers = {
         'Authorization': f'Bearer {access_token}',
         'Content-Type': 'application/json'
     }
-    
-    all_results = []
-    after = None
-    
+    body = {
+        'limit': limit,
+        'after': after,
+        'properties': HUBSPOT_PROPERTIES,
+        'sorts': [{'propertyName': 'hs_object_id', 'direction': 'ASCENDING'}],
+    }
+    if last_id is not None:
+        # Resume past the search window cap by filtering on the last id seen
+        body['filterGroups'] = [{'filters': [{'propertyName': 'hs_object_id', 'operator': 'GT', 'value': last_id}]}]
+
+    response = await _hubspot_request(client, 'POST', url, access_token, search=True, headers=headers, json=body)
+
+    if response.status_code == 401:
+        _invalidate_hubspot_credentials(access_token)
+
+    if response.status_code != 200:
+        # Fail the whole object type rather than letting it end early as if complete
+        raise httpx.HTTPStatusError(
+            f"Error fetching {object_type}: {response.status_code} - {response.text}",
+            request=response.request,
+            response=response,
+        )
+
+    return orjson.loads(response.content)
+
+async def fetch_hubspot_objects(
+    client: httpx.AsyncClient, access_token: str, object_type: str, limit=100
+) -> AsyncIterator[list[dict]]:
+    """Yield pages of objects from HubSpot CRM API, requesting several pages ahead at a time"""
+    after = 0
+    last_id = None
+    last_seen_id = None
+
+    # The search API pages by numeric offset, so once the first page shows there
+    # is more to read the following pages can be requested concurrently. The
+    # first page doubles as the probe for empty object types, which stop here.
+    pages = [await fetch_hubspot_page(client, access_token, object_type, after, last_id, limit)]
+
     while True:
-        params = {'limit': limit}
-        if after:
-            params['after'] = after
-            
-        response = requests.get(url, headers=headers, params=params)
-        
-        if response.status_code != 200:
-            print(f"Error fetching {object_type}: {response.status_code} - {response.text}")
-            break
-            
-        data = response.json()
-        results = data.get('results', [])
-        all_results.extend(results)
-        
-        # Check for pagination
-        paging = data.get('paging', {})
-        after = paging.get('next', {}).get('after')
-        
-        if not after:
-            break
-    
-    return all_results
+        for data in pages:
+            if not data['results']:
+                return
+            results = data['results']
+            yield results
+            last_seen_id = results[-1]['id']
+
+            if 'next' not in data.get('paging', _EMPTY):
+                return
+
+        after += len(pages) * limit
+
+        # total counts every match of the current query, so never look ahead past its end
+        remaining = data['total'] - after
+        if remaining <= 0:
+            return
+
+        if after + SEARCH_PAGE_LOOKAHEAD * limit > SEARCH_RESULT_CAP:
+            after = 0
+            last_id = last_seen_id
+
+        pages = await asyncio.gather(*(
+            fetch_hubspot_page(client, access_token, object_type, after + i * limit, last_id, limit)
+            for i in range(min(SEARCH_PAGE_LOOKAHEAD, -(-remaining // limit)))
+        ))
+
+async def fetch_hubspot_contact_companies(client: httpx.AsyncClient, access_token: str, contact_ids: list) -> dict:
+    """Map contact ids to their primary company id with a single batch associations call"""
+    url = 'https://api.hubapi.com/crm/v3/associations/contacts/companies/batch/read'
+    headers = {
+        'Authorization': f'Bearer {access_token}',
+        'Content-Type': 'application/json'
+    }
+    body = {'inputs': [{'id': contact_id} for contact_id in contact_ids]}
+
+    response = await _hubspot_request(client, 'POST', url, access_token, headers=headers, json=body)
+
+    if response.status_code == 401:
+        _invalidate_hubspot_credentials(access_token)
+
+    # 207 means some contacts had no companies, which is expected
+    if response.status_code not in (200, 207):
+        logger.warning('Error fetching contact companies: %s - %s', response.status_code, response.text)
+        return {}
+
+    contact_companies = {}
+    for result in orjson.loads(response.content).get('results', []):
+        companies = result.get('to')
+        if not companies:
+            continue
+        primary = next((c for c in companies if c.get('type') == 'contact_to_company'), companies[0])
+        contact_companies[result['from']['id']] = primary['id']
+
+    return contact_companies
+
+async def add_hubspot_contact_items(access_token: str, contacts: list[dict], items: list[IntegrationItem]):
+    contact_companies = await fetch_hubspot_contact_companies(
+        _http_client, access_token, [contact['id'] for contact in contacts]
+    )
+    contact_type = HUBSPOT_ITEM_TYPES['contacts']
+    company_suffix = '_' + HUBSPOT_ITEM_TYPES['companies']
+    for contact in contacts:
+        company_id = contact_companies.get(contact['id'])
+        parent_id = None if company_id is None else company_id + company_suffix
+        items.append(
+            create_integration_item_metadata_object(contact, contact_type, parent_id, id_suffix='_' + contact_type)
+        )
+
+async def collect_hubspot_contacts(access_token: str, items: list[IntegrationItem]):
+    """Builds contact items parented to their company, resolving associations in batches"""
+    contacts = []
+    async for page in fetch_hubspot_objects(_http_client, access_token, 'contacts'):
+        contacts.extend(page)
+        while len(contacts) >= ASSOCIATION_BATCH_SIZE:
+            await add_hubspot_contact_items(access_token, contacts[:ASSOCIATION_BATCH_SIZE], items)
+            contacts = contacts[ASSOCIATION_BATCH_SIZE:]
+
+    if contacts:
+        await add_hubspot_contact_items(access_token, contacts, items)
+
+async def collect_hubspot_items(access_token: str, object_type: str, items: list[IntegrationItem]):
+    """Builds integration items for one object type as its pages arrive"""
+    item_type = HUBSPOT_ITEM_TYPES[object_type]
+    id_suffix = '_' + item_type
+    # Items land in the shared list only once the whole type has been read, so
+    # a type that fails partway contributes nothing rather than a truncated list
+    type_items = []
+    try:
+        if object_type == 'contacts':
+            await collect_hubspot_contacts(access_token, type_items)
+        else:
+            async for page in fetch_hubspot_objects(_http_client, access_token, object_type):
+                type_items.extend([
+                    create_integration_item_metadata_object(obj, item_type, id_suffix=id_suffix) for obj in page
+                ])
+    except Exception:
+        # Swallow the error so one failing type doesn't cancel the others
+        logger.exception('Error processing %s', object_type)
+        return
+
+    items.extend(type_items)
 
 async def get_items_hubspot(credentials) -> list[IntegrationItem]:
     """Aggregates all metadata relevant for a HubSpot integration"""
@@ -208,24 +435,18 @@ async def get_items_hubspot(credentials) -> list[IntegrationItem]:
     
     list_of_integration_item_metadata = []
     
-    # Define the HubSpot object types to fetch
-    object_types = ['contacts', 'companies', 'deals', 'tickets', 'tasks', 'calls', 'meetings', 'notes', 'emails']
+    # Consume every object type concurrently so a slow type doesn't hold up the
+    # rest; all of their requests share the per-token HubSpot rate limits
+    async with asyncio.TaskGroup() as tg:
+        for object_type in HUBSPOT_ITEM_TYPES:
+            tg.create_task(collect_hubspot_items(access_token, object_type, list_of_integration_item_metadata))
     
-    for object_type in object_types:
-        try:
-            objects = fetch_hubspot_objects(access_token, object_type)
-            
-            for obj in objects:
-                integration_item = create_integration_item_metadata_object(
-                    obj, 
-                    object_type.rstrip('s')  # Remove plural 's' for item type
-                )
-                list_of_integration_item_metadata.append(integration_item)
-                
-        except Exception as e:
-            print(f"Error processing {object_type}: {str(e)}")
-            continue
+    # Contacts only know their company's id until every company has been read
+    company_names = {item.id: item.name for item in list_of_integration_item_metadata if item.type == HUBSPOT_ITEM_TYPES['companies']}
+    for item in list_of_integration_item_metadata:
+        if item.parent_id is not None:
+            item.parent_path_or_name = company_names.get(item.parent_id)
     
-    print(f'HubSpot integration items count: {len(list_of_integration_item_metadata)}')
-    print(f'HubSpot integration items: {list_of_integration_item_metadata}')
+    logger.debug('HubSpot integration items count=%d', len(list_of_integration_item_metadata))
+    logger.debug('HubSpot integration items sample=%r', list_of_integration_item_metadata[:5])
     return list_of_integration_item_metadata
\ No newline at end of file
@@ -2,6 +2,23 @@ from datetime import datetime
 from typing import Optional, List
 
 class IntegrationItem:
+    __slots__ = (
+        'id',
+        'type',
+        'directory',
+        'parent_path_or_name',
+        'parent_id',
+        'name',
+        'creation_time',
+        'last_modified_time',
+        'url',
+        'children',
+        'mime_type',
+        'delta',
+        'drive_id',
+        'visibility',
+    )
+
     def __init__(
         self,
         id: Optional[str] = None,
@@ -33,3 +50,9 @@ class IntegrationItem:
         self.delta = delta
         self.drive_id = drive_id
         self.visibility = visibility
+
+    def __iter__(self):
+        # Slotted instances have no __dict__, so expose fields as key/value
+        # pairs for dict(item) and FastAPI's jsonable_encoder
+        for field in self.__slots__:
+            yield field, getattr(self, field)
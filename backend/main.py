@@ -3,7 +3,7 @@ from fastapi.middleware.cors import CORSMiddleware
 
 from integrations.airtable import authorize_airtable, get_items_airtable, oauth2callback_airtable, get_airtable_credentials
 from integrations.notion import authorize_notion, get_items_notion, oauth2callback_notion, get_notion_credentials
-from integrations.hubspot import authorize_hubspot, get_hubspot_credentials, get_items_hubspot, oauth2callback_hubspot
+from integrations.hubspot import authorize_hubspot, close_hubspot_client, get_hubspot_credentials, get_items_hubspot, oauth2callback_hubspot
 
 app = FastAPI()
 
@@ -19,6 +19,10 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event('shutdown')
+async def shutdown():
+    await close_hubspot_client()
+
 @app.get('/')
 def read_root():
     return {'Ping': 'Pong'}
@@ -3,15 +3,18 @@ import redis.asyncio as redis
 from kombu.utils.url import safequote
 
 redis_host = safequote(os.environ.get('REDIS_HOST', 'localhost'))
-redis_client = redis.Redis(host=redis_host, port=6379, db=0)
+redis_pool = redis.BlockingConnectionPool(host=redis_host, port=6379, db=0, max_connections=50)
+redis_client = redis.Redis(connection_pool=redis_pool)
 
 async def add_key_value_redis(key, value, expire=None):
-    await redis_client.set(key, value)
-    if expire:
-        await redis_client.expire(key, expire)
+    await redis_client.set(key, value, ex=expire)
 
 async def get_value_redis(key):
     return await redis_client.get(key)
 
 async def delete_key_redis(key):
     await redis_client.delete(key)
+
+async def add_key_value_delete_key_redis(key, value, delete_key, expire=None):
+    async with redis_client.pipeline(transaction=True) as pipe:
+        await pipe.set(key, value, ex=expire).delete(delete_key).execute()